@@ -0,0 +1,170 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# period used to set the cpu quota of the containers (microseconds)
+CPU_PERIOD = 100000
+
+
+def host_cpus():
+    """list of the cpus available to this process"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def set_affinity(cpus):
+    """pin the current process to the cpus. Does nothing on platforms
+    without sched_setaffinity"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def host_memory():
+    """total physical memory of the host in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ThreadBudget(object):
+    """Split the host cores and memory between the scenes being processed in
+    parallel. The cores are divided into n_parallel slots. Scenes register while
+    they are in a compute heavy stage (ETAD correction, RTC container) and are
+    given a free slot, which does not change while the scene is registered.
+
+    Scenes that can be updated while running (RTC containers) are also given the
+    cores of the free slots, shared between them. These spare cores move as other
+    scenes start and finish, so running containers should be updated with the
+    latest allocation. Scenes that cannot be updated (ETAD) only use their slot.
+
+    The thread count of a scene is fixed at the size of a slot (cpus // n_parallel)
+    as threads cannot be changed once a container starts, so rebalancing never
+    shrinks a scene below its threads.
+
+    State is held in a multiprocessing manager so the budget can be shared with
+    the workers of a ProcessPoolExecutor.
+
+    Args:
+        n_parallel (int): maximum number of scenes processed at once
+        manager (multiprocessing.managers.SyncManager): manager to hold the shared state
+        reserved_cores (int, optional): cores left free for the main process and
+            downloads. Defaults to 0.
+        memory_fraction (float, optional): fraction of the host memory to split
+            between the scenes. Defaults to 0.8.
+    """
+
+    def __init__(self, n_parallel, manager, reserved_cores=0, memory_fraction=0.8):
+        cpus = host_cpus()
+        if reserved_cores >= len(cpus):
+            raise ValueError(f'reserved_cores ({reserved_cores}) must be less than '
+                             f'the number of cpus ({len(cpus)})')
+        self.cpus = cpus[reserved_cores:]
+        self.n_parallel = max(1, n_parallel)
+        self.n_threads = max(1, len(self.cpus) // self.n_parallel)
+        # memory is split by the maximum number of scenes rather than the active scenes
+        # as lowering the limit of a running container may cause it to be killed
+        self.mem_limit = int(host_memory() * memory_fraction / max(1, n_parallel))
+        # scene -> (slot, updatable)
+        self._active = manager.dict()
+        self._lock = manager.Lock()
+        logger.info(f'Thread budget: {len(self.cpus)} cpus, {self.n_threads} threads '
+                    f'and {self.mem_limit / 1e9:.1f} GB memory per scene')
+
+    def _slot_cpus(self, slot):
+        """the cpus belonging to a slot"""
+        size, extra = divmod(len(self.cpus), self.n_parallel)
+        if size == 0:
+            # more slots than cpus, share cpus between slots
+            return [self.cpus[slot % len(self.cpus)]]
+        start = slot * size + min(slot, extra)
+        return self.cpus[start:start + size + (1 if slot < extra else 0)]
+
+    def acquire(self, scene, updatable=False):
+        """Register a scene as active in a free slot and return its allocation
+
+        Args:
+            scene (str): the scene
+            updatable (bool, optional): whether the cpus of the scene can be changed
+                while it is running. Only these scenes are given the cpus of free
+                slots. Defaults to False.
+        """
+        with self._lock:
+            if scene not in self._active:
+                used = {slot for slot, _ in self._active.values()}
+                free = [i for i in range(self.n_parallel) if i not in used]
+                if len(free) == 0:
+                    raise RuntimeError(f'No free thread budget slot for {scene}, '
+                                       f'{self.n_parallel} scenes already active')
+                self._active[scene] = (free[0], updatable)
+        allocation = self.allocation(scene)
+        logger.info(f'Thread budget acquired for {scene}: {allocation}')
+        return allocation
+
+    def release(self, scene):
+        """Remove a scene from the active scenes, freeing its cores"""
+        with self._lock:
+            self._active.pop(scene, None)
+        logger.info(f'Thread budget released for {scene}')
+
+    def allocation(self, scene):
+        """Get the current allocation for an active scene
+
+        Args:
+            scene (str): the scene
+
+        Returns:
+            dict: cpus, n_threads and mem_limit (bytes) for the scene. n_threads
+                is fixed, the cpus always include the slot of the scene. None if the
+                scene is not active
+        """
+        with self._lock:
+            active = dict(self._active)
+        if scene not in active:
+            return None
+        slot, updatable = active[scene]
+        cpus = self._slot_cpus(slot)
+        if updatable:
+            # share the cpus of the free slots between the updatable scenes
+            used = {s for s, _ in active.values()}
+            spare = [c for i in range(self.n_parallel) if i not in used
+                     for c in self._slot_cpus(i)]
+            receivers = sorted(s for s, u in active.values() if u)
+            k = receivers.index(slot)
+            cpus = sorted(set(cpus + spare[k::len(receivers)]))
+        return {
+            'cpus': cpus,
+            'n_threads': self.n_threads,
+            'mem_limit': self.mem_limit,
+        }
+
+
+def thread_env(n_threads):
+    """environment variables setting the number of threads used by OpenMP and GDAL"""
+    return {
+        'OMP_NUM_THREADS': str(n_threads),
+        'GDAL_NUM_THREADS': str(n_threads),
+    }
+
+
+def container_limits(allocation):
+    """keyword arguments for docker containers.run limiting the resources
+    of the container to the allocation. The cpu quota is set with
+    cpu_period/cpu_quota (rather than nano_cpus) so it can be updated on
+    a running container with container_update_limits"""
+    return {
+        'cpuset_cpus': ','.join(str(c) for c in allocation['cpus']),
+        'cpu_period': CPU_PERIOD,
+        'cpu_quota': CPU_PERIOD * len(allocation['cpus']),
+        'mem_limit': allocation['mem_limit'],
+        'environment': thread_env(allocation['n_threads']),
+    }
+
+
+def container_update_limits(allocation):
+    """keyword arguments for docker container.update to rebalance the cpus
+    of a running container. Memory and thread counts are fixed at start"""
+    return {
+        'cpuset_cpus': ','.join(str(c) for c in allocation['cpus']),
+        'cpu_period': CPU_PERIOD,
+        'cpu_quota': CPU_PERIOD * len(allocation['cpus']),
+    }
@@ -0,0 +1,249 @@
+import os
+import json
+import logging
+import numpy as np
+import rasterio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# suffixes of the backscatter layers written by OPERA RTC
+POLARIZATIONS = ['HH', 'HV', 'VV', 'VH']
+
+# suffix of the layover shadow mask and the values it contains
+# see - https://github.com/opera-adt/RTC
+MASK_SUFFIX = 'mask'
+MASK_VALUES = {'shadow': 1, 'layover': 2, 'layover_shadow': 3}
+
+# histogram used to summarise the backscatter layers in dB
+DB_HIST_MIN = -50.0
+DB_HIST_MAX = 20.0
+DB_HIST_BIN_WIDTH = 0.5
+DB_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+# thresholds that can be checked, a value of None skips the check
+DEFAULT_QA_THRESHOLDS = {
+    'max_nodata_fraction': None,
+    'max_layover_shadow_fraction': None,
+    'min_median_db': None,
+    'max_median_db': None,
+    'max_above_range_fraction': None,
+}
+
+
+def layer_type(tif_path, prod_id):
+    """Get the type of an OPERA RTC output layer from its filename
+
+    Args:
+        tif_path (str): path to the layer. e.g. OPERA_L2_RTC-{scene}_VV.tif
+        prod_id (str): the product id used as the filename prefix
+
+    Returns:
+        str: 'backscatter', 'mask' or 'ancillary'
+    """
+    suffix = os.path.basename(tif_path).replace(prod_id, '').replace('.tif', '').strip('_')
+    if suffix in POLARIZATIONS:
+        return 'backscatter'
+    if suffix == MASK_SUFFIX:
+        return 'mask'
+    return 'ancillary'
+
+
+def _valid_pixels(data, nodata):
+    """boolean array of the pixels that are not nodata"""
+    valid = np.ones(data.shape, dtype=bool)
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= np.isfinite(data)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= (data != nodata)
+    return valid
+
+
+def _percentiles_from_hist(hist, bin_edges, percentiles, n_under=0, n_over=0):
+    """Estimate percentiles from a histogram. Values are accurate to the bin width.
+    Values outside the histogram are counted in underflow and overflow bins, a
+    percentile falling in one of these is set to the edge of the histogram range.
+
+    Returns:
+        tuple: dict of percentiles, list of the percentiles outside the range
+    """
+    counts = np.concatenate([[n_under], hist, [n_over]])
+    total = counts.sum()
+    if total == 0:
+        return {f'p{p}': None for p in percentiles}, []
+    cumulative = np.cumsum(counts) / total
+    centres = (bin_edges[:-1] + bin_edges[1:]) / 2
+    out, out_of_range = {}, []
+    for p in percentiles:
+        idx = int(np.searchsorted(cumulative, p / 100))
+        if idx == 0:
+            value = bin_edges[0]
+            out_of_range.append(f'p{p}')
+        elif idx > len(centres):
+            value = bin_edges[-1]
+            out_of_range.append(f'p{p}')
+        else:
+            value = centres[idx - 1]
+        out[f'p{p}'] = round(float(value), 2)
+    return out, out_of_range
+
+
+def layer_statistics(tif_path, kind='ancillary'):
+    """Compute QA statistics for a single band raster. The raster is read
+    block by block so memory use is bounded by the block size of the COG
+
+    Args:
+        tif_path (str): path to the raster
+        kind (str, optional): type of layer, one of 'backscatter', 'mask' or 'ancillary'.
+            Backscatter layers are summarised with a histogram and percentiles in dB,
+            masks with the coverage of each mask value. Defaults to 'ancillary'.
+
+    Returns:
+        dict: statistics for the layer
+    """
+    bin_edges = np.arange(DB_HIST_MIN, DB_HIST_MAX + DB_HIST_BIN_WIDTH, DB_HIST_BIN_WIDTH)
+    hist = np.zeros(len(bin_edges) - 1, dtype=np.int64)
+    n_total, n_valid = 0, 0
+    n_below, n_above, n_nonpositive = 0, 0, 0
+    mask_counts = {k: 0 for k in MASK_VALUES}
+    v_min, v_max, v_sum = np.inf, -np.inf, 0.0
+
+    with rasterio.open(tif_path) as src:
+        nodata = src.nodata
+        for _, window in src.block_windows(1):
+            data = src.read(1, window=window)
+            valid = _valid_pixels(data, nodata)
+            values = data[valid]
+            n_total += data.size
+            n_valid += values.size
+            if values.size == 0:
+                continue
+            if kind == 'backscatter':
+                n_nonpositive += int((values <= 0).sum())
+                db = 10 * np.log10(values[values > 0].astype(np.float64))
+                n_below += int((db < DB_HIST_MIN).sum())
+                n_above += int((db > DB_HIST_MAX).sum())
+                hist += np.histogram(db, bins=bin_edges)[0]
+            elif kind == 'mask':
+                for k, v in MASK_VALUES.items():
+                    mask_counts[k] += int((values == v).sum())
+            else:
+                v_min = min(v_min, float(values.min()))
+                v_max = max(v_max, float(values.max()))
+                v_sum += float(values.sum(dtype=np.float64))
+
+    stats = {
+        'type': kind,
+        'n_pixels': n_total,
+        'n_valid': n_valid,
+        'nodata_fraction': round(1 - n_valid / n_total, 6) if n_total else None,
+    }
+    if kind == 'backscatter':
+        n_db = n_valid - n_nonpositive
+        stats['nonpositive_fraction'] = round(n_nonpositive / n_valid, 6) if n_valid else None
+        stats['below_range_fraction'] = round(n_below / n_db, 6) if n_db else None
+        stats['above_range_fraction'] = round(n_above / n_db, 6) if n_db else None
+        # values <= 0 are below any dB value so are counted with the underflow
+        percentiles, out_of_range = _percentiles_from_hist(
+            hist, bin_edges, DB_PERCENTILES,
+            n_under=n_below + n_nonpositive, n_over=n_above)
+        stats['percentiles_db'] = percentiles
+        stats['percentiles_out_of_range'] = out_of_range
+        stats['histogram_db'] = {
+            'min': DB_HIST_MIN,
+            'max': DB_HIST_MAX,
+            'bin_width': DB_HIST_BIN_WIDTH,
+            'counts': hist.tolist(),
+        }
+    elif kind == 'mask':
+        coverage = {k: round(c / n_valid, 6) if n_valid else None for k, c in mask_counts.items()}
+        coverage['layover_or_shadow'] = (
+            round(sum(mask_counts.values()) / n_valid, 6) if n_valid else None)
+        stats['coverage'] = coverage
+    else:
+        stats['min'] = v_min if n_valid else None
+        stats['max'] = v_max if n_valid else None
+        stats['mean'] = v_sum / n_valid if n_valid else None
+    return stats
+
+
+def check_qa_thresholds(layers, thresholds):
+    """Check the layer statistics against the QA thresholds
+
+    Args:
+        layers (dict): statistics for each layer from layer_statistics
+        thresholds (dict): thresholds, see DEFAULT_QA_THRESHOLDS. None skips a check
+
+    Returns:
+        list: a message for each failed check. Empty if all checks pass
+    """
+    thresholds = {**DEFAULT_QA_THRESHOLDS, **(thresholds or {})}
+    failed = []
+
+    def _check(name, layer, value, limit, greater):
+        if limit is None or value is None:
+            return
+        if (value > limit) if greater else (value < limit):
+            op = '>' if greater else '<'
+            failed.append(f'{layer}: {name} {value} {op} {limit}')
+
+    for layer, stats in layers.items():
+        if stats['type'] in ['backscatter', 'mask']:
+            _check('nodata_fraction', layer, stats['nodata_fraction'],
+                   thresholds['max_nodata_fraction'], greater=True)
+        if stats['type'] == 'backscatter':
+            median = stats['percentiles_db']['p50']
+            _check('median_db', layer, median, thresholds['min_median_db'], greater=False)
+            _check('median_db', layer, median, thresholds['max_median_db'], greater=True)
+            _check('above_range_fraction', layer, stats['above_range_fraction'],
+                   thresholds['max_above_range_fraction'], greater=True)
+        if stats['type'] == 'mask':
+            _check('layover_or_shadow', layer, stats['coverage']['layover_or_shadow'],
+                   thresholds['max_layover_shadow_fraction'], greater=True)
+    return failed
+
+
+def run_scene_qa(out_folder, prod_id, qa_path, n_threads=None, thresholds=None):
+    """Compute QA statistics for all output layers of a scene and write them
+    to a json sidecar. Layers are processed in parallel with a thread pool.
+
+    Args:
+        out_folder (str): folder containing the OPERA RTC outputs for the scene
+        prod_id (str): the product id of the outputs. e.g. OPERA_L2_RTC-{scene}
+        qa_path (str): path to write the json sidecar
+        n_threads (int, optional): number of threads. Defaults to one per layer.
+        thresholds (dict, optional): thresholds to check, see DEFAULT_QA_THRESHOLDS.
+            Defaults to None.
+
+    Returns:
+        dict: the QA summary written to qa_path
+    """
+    tifs = sorted([os.path.join(out_folder, x) for x in os.listdir(out_folder)
+                   if x.startswith(prod_id) and x.endswith('.tif')])
+    if len(tifs) == 0:
+        raise FileNotFoundError(f'No output layers found for {prod_id} in {out_folder}')
+    n_threads = len(tifs) if n_threads is None else max(1, min(n_threads, len(tifs)))
+    logger.info(f'Computing QA statistics for {len(tifs)} layers with {n_threads} threads')
+
+    layers = {}
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {executor.submit(layer_statistics, tif, layer_type(tif, prod_id)): tif
+                   for tif in tifs}
+        for future in as_completed(futures):
+            layers[os.path.basename(futures[future])] = future.result()
+
+    failed = check_qa_thresholds(layers, thresholds)
+    for msg in failed:
+        logger.warning(f'QA check failed - {msg}')
+
+    qa = {
+        'product_id': prod_id,
+        'passed': len(failed) == 0,
+        'failed_checks': failed,
+        'thresholds': {**DEFAULT_QA_THRESHOLDS, **(thresholds or {})},
+        'layers': {k: layers[k] for k in sorted(layers)},
+    }
+    with open(qa_path, 'w') as fp:
+        json.dump(qa, fp)
+    logger.info(f'QA sidecar written to : {qa_path}')
+    return qa
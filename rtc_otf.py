@@ -11,10 +11,13 @@ import rasterio
 import docker
 from utils import *
 from etad import *
+from qa import *
+from budget import *
 import time
 import shutil
 import json
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
 import traceback
 
 def setup_logging(log_path):
@@ -64,7 +67,7 @@ def update_timing_file(key, time, path, replace=False):
     with open(path, 'w') as fp:
         json.dump(timing, fp)
     
-def run_process(config, scene):
+def run_process(config, scene, budget=None):
 
     # read in the config for on the fly (otf) processing
     with open(config, 'r', encoding='utf8') as fin:
@@ -151,11 +154,34 @@ def run_process(config, scene):
             copernicus_pswd, etad_dir=otf_cfg['ETAD_folder'])
         ETAD_SCENE_FOLDER = f'{otf_cfg["scene_folder"]}_ETAD'
         logging.info(f'making new directory for etad corrected slc : {ETAD_SCENE_FOLDER}')
-        ETAD_SAFE_PATH = apply_etad_correction(
-            ORIGINAL_SAFE_PATH, 
-            etad_path, 
-            out_dir=ETAD_SCENE_FOLDER,
-            nthreads=otf_cfg['gdal_threads'])
+        etad_threads = otf_cfg['gdal_threads']
+        if budget is not None:
+            # limit the etad correction to the cores allocated to the scene.
+            # nthreads and the affinity do the limiting, the env vars only affect
+            # libraries that read them at call time (e.g. GDAL)
+            all_cpus = host_cpus()
+            allocation = budget.acquire(scene)
+            etad_threads = allocation['n_threads']
+            etad_env = thread_env(etad_threads)
+            prev_env = {k: os.environ.get(k) for k in etad_env}
+            os.environ.update(etad_env)
+            set_affinity(allocation['cpus'])
+        try:
+            ETAD_SAFE_PATH = apply_etad_correction(
+                ORIGINAL_SAFE_PATH, 
+                etad_path, 
+                out_dir=ETAD_SCENE_FOLDER,
+                nthreads=etad_threads)
+        finally:
+            if budget is not None:
+                budget.release(scene)
+                set_affinity(all_cpus)
+                # the worker is reused for later scenes, restore its environment
+                for k, v in prev_env.items():
+                    if v is None:
+                        os.environ.pop(k, None)
+                    else:
+                        os.environ[k] = v
     
     # set as the safe file for processing
     SAFE_PATH = ORIGINAL_SAFE_PATH if not otf_cfg['apply_ETAD'] else ETAD_SAFE_PATH
@@ -288,6 +314,11 @@ def run_process(config, scene):
     logging.info(f'logs will be saved to {LOG_PATH}')
     
     if not otf_cfg["skip_rtc"]:
+        # limit the container to the cores and memory allocated to the scene
+        limits = {}
+        if budget is not None:
+            allocation = budget.acquire(scene, updatable=True)
+            limits = container_limits(allocation)
         container = client.containers.run(f'opera/rtc:final_1.0.4-atmosbugfix', 
                             docker_command, 
                             volumes=volumes, 
@@ -295,7 +326,8 @@ def run_process(config, scene):
                             detach=True, 
                             stdout=True, 
                             stderr=True,
-                            stream=True)
+                            stream=True,
+                            **limits)
         
         l, t = 0, 0
         # show the logs while the container is running
@@ -310,6 +342,19 @@ def run_process(config, scene):
                     l = len(logs)
                 container.reload()
                 t = int(time.time())
+                # rebalance the cores as other scenes start and finish
+                if budget is not None:
+                    new_allocation = budget.allocation(scene)
+                    if new_allocation is not None and new_allocation['cpus'] != allocation['cpus']:
+                        logging.info(f'Rebalancing container cpus: {new_allocation["cpus"]}')
+                        try:
+                            container.update(**container_update_limits(new_allocation))
+                            allocation = new_allocation
+                        except docker.errors.APIError as e:
+                            logging.warning(f'Failed to update container: {e}')
+
+        if budget is not None:
+            budget.release(scene)
 
         # write the logs from the container
         with open(LOG_PATH, 'w') as f:
@@ -340,19 +385,48 @@ def run_process(config, scene):
     
     t4 = time.time()
     update_timing_file('RTC Processing', t4 - t3, TIMING_FILE_PATH)
-        
+
+    # set the path in the bucket
+    bucket = otf_cfg['s3_bucket']
+    SCENE_PREFIX = '' if otf_cfg["scene_prefix"] == None else otf_cfg["scene_prefix"]
+    S3_BUCKET_FOLDER = '' if otf_cfg["s3_bucket_folder"] == None else otf_cfg["s3_bucket_folder"]
+    bucket_folder = os.path.join(S3_BUCKET_FOLDER,
+                                    otf_cfg["software"],
+                                    otf_cfg['dem_type'],
+                                    f'{trg_crs.split(":")[-1]}',
+                                    f'{SCENE_PREFIX}{SCENE_NAME}')
+
+    if otf_cfg.get('run_qa', False):
+        logging.info(f'PROCESS 3: QA statistics for output layers')
+        # the sidecar is prefixed with the product id so it is uploaded with the products
+        QA_PATH = os.path.join(SCENE_OUT_FOLDER, prod_id + '_qa.json')
+        qa_threads = otf_cfg.get('qa_threads')
+        if budget is not None:
+            # keep the qa threads within the share of the cores for a scene
+            qa_threads = min(qa_threads or budget.n_threads, budget.n_threads)
+        qa = run_scene_qa(SCENE_OUT_FOLDER,
+                          prod_id,
+                          QA_PATH,
+                          n_threads=qa_threads,
+                          thresholds=otf_cfg.get('qa_thresholds'))
+        update_timing_file('QA', time.time() - t4, TIMING_FILE_PATH)
+        if not qa['passed'] and otf_cfg.get('qa_fail_on_threshold', False):
+            # upload the sidecar and timings so failed scenes can be screened remotely
+            if otf_cfg['push_to_s3']:
+                for file_path in [QA_PATH, TIMING_FILE_PATH]:
+                    bucket_path = os.path.join(bucket_folder, os.path.basename(file_path))
+                    logging.info(f'Uploading file: {file_path}')
+                    logging.info(f'Destination: {bucket_path}')
+                    upload_file(file_name=file_path, 
+                                bucket=bucket, 
+                                object_name=bucket_path)
+            raise ValueError(f'QA checks failed: {qa["failed_checks"]}')
+
+    t5 = time.time()
+
     if otf_cfg['push_to_s3']:
-        logging.info(f'PROCESS 3: Push results to S3 bucket')
-        bucket = otf_cfg['s3_bucket']
+        logging.info(f'PROCESS 4: Push results to S3 bucket')
         outputs = [x for x in os.listdir(SCENE_OUT_FOLDER) if SCENE_NAME in x]
-        # set the path in the bucket
-        SCENE_PREFIX = '' if otf_cfg["scene_prefix"] == None else otf_cfg["scene_prefix"]
-        S3_BUCKET_FOLDER = '' if otf_cfg["s3_bucket_folder"] == None else otf_cfg["s3_bucket_folder"]
-        bucket_folder = os.path.join(S3_BUCKET_FOLDER,
-                                        otf_cfg["software"],
-                                        otf_cfg['dem_type'],
-                                        f'{trg_crs.split(":")[-1]}',
-                                        f'{SCENE_PREFIX}{SCENE_NAME}')
         for file_ in outputs:
             file_path = os.path.join(SCENE_OUT_FOLDER,file_)
             bucket_path = os.path.join(bucket_folder,file_)
@@ -376,11 +450,11 @@ def run_process(config, scene):
                         bucket=bucket, 
                         object_name=bucket_path)
             
-    t5 = time.time()
-    update_timing_file('S3 Upload', t5 - t4, TIMING_FILE_PATH)
+    t6 = time.time()
+    update_timing_file('S3 Upload', t6 - t5, TIMING_FILE_PATH)
 
     if otf_cfg['delete_local_files']:
-        logging.info(f'PROCESS 4: Clear files locally')
+        logging.info(f'PROCESS 5: Clear files locally')
         #clear downloads
         for file_ in [scene_zip,
                     DEM_PATH,
@@ -398,11 +472,11 @@ def run_process(config, scene):
         shutil.rmtree(SCENE_OUT_FOLDER)
         shutil.rmtree(SCENE_SCRATCH_FOLDER)
     
-    t6 = time.time()
-    update_timing_file('Delete Files', t6 - t5, TIMING_FILE_PATH)
+    t7 = time.time()
+    update_timing_file('Delete Files', t7 - t6, TIMING_FILE_PATH)
 
     logging.info(f'Scene finished: {SCENE_NAME}')
-    logging.info(f'Elapsed time: {((t6 - t0)/60)} minutes')
+    logging.info(f'Elapsed time: {((t7 - t0)/60)} minutes')
 
     # push timings + logs to s3
     if otf_cfg['push_to_s3']:
@@ -420,13 +494,17 @@ def run_process(config, scene):
                     object_name=bucket_path)
         os.remove(TIMING_FILE_PATH)
     
-def process_scene(config_path, scene):
+def process_scene(config_path, scene, budget=None):
     try:
-        run_process(config_path, scene)
+        run_process(config_path, scene, budget=budget)
         return (scene, True, None)
     except Exception as e:
         tb_str = traceback.format_exc()
         return (scene, False, tb_str)
+    finally:
+        # free the cores of the scene if it failed during a compute stage
+        if budget is not None:
+            budget.release(scene)
     
 if __name__ == "__main__":
 
@@ -449,8 +527,17 @@ if __name__ == "__main__":
     n_parallel = otf_cfg['n_parallel']
     logging.info(f'Starting processing with {n_parallel} parallel workers')
 
+    # split the host cores and memory between the scenes running in parallel
+    manager, budget = None, None
+    if otf_cfg.get('thread_budget', False):
+        manager = Manager()
+        budget = ThreadBudget(n_parallel, 
+                              manager, 
+                              reserved_cores=otf_cfg.get('budget_reserved_cores', 0),
+                              memory_fraction=otf_cfg.get('budget_memory_fraction', 0.8))
+
     with ProcessPoolExecutor(max_workers=n_parallel) as executor:
-        futures = [executor.submit(process_scene, args.config, scene) for scene in scenes]
+        futures = [executor.submit(process_scene, args.config, scene, budget) for scene in scenes]
         for future in as_completed(futures):
             scene, ok, tb = future.result()
             if ok:
@@ -459,6 +546,9 @@ if __name__ == "__main__":
                 failed['opera-rtc'].append(scene)
                 logging.error(f"Scene {scene} failed with traceback:\n{tb}")
 
+    if manager is not None:
+        manager.shutdown()
+
     logging.info(f'Run complete, attempted to process {len(otf_cfg["scenes"])} scenes')
     logging.info(f'{len(success["opera-rtc"])} scenes successfully processed: ')
     for s in success['opera-rtc']:
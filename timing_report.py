@@ -0,0 +1,234 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import logging
+from datetime import datetime, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+import boto3
+
+logger = logging.getLogger(__name__)
+
+TIMING_SUFFIX = '_timing.json'
+
+
+def list_timing_files(path, s3_client=None):
+    """List the timing files in a local directory or s3 prefix
+
+    Args:
+        path (str): local directory or s3 prefix. e.g. s3://bucket/folder
+        s3_client (botocore.client.S3, optional): client used for s3 prefixes
+
+    Returns:
+        list: (path, last modified datetime) for each timing file
+    """
+    if path.startswith('s3://'):
+        bucket, _, prefix = path[5:].partition('/')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        files = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(TIMING_SUFFIX):
+                    files.append((f's3://{bucket}/{obj["Key"]}', obj['LastModified']))
+        return files
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            if name.endswith(TIMING_SUFFIX):
+                file_path = os.path.join(root, name)
+                modified = datetime.fromtimestamp(os.path.getmtime(file_path), tz=timezone.utc)
+                files.append((file_path, modified))
+    return files
+
+
+def read_timing_file(path, s3_client=None):
+    """read a timing json from a local path or s3 url"""
+    if path.startswith('s3://'):
+        bucket, _, key = path[5:].partition('/')
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        return json.loads(body)
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def run_group(path, root):
+    """Get the group a timing file belongs to from its location. Uploaded files
+    are stored at {s3_bucket_folder}/{software}/{dem_type}/{trg_crs}/{scene}/ so
+    the software and config are taken from the folders above the scene. Local
+    files are grouped by their folder relative to the root.
+    """
+    if path.startswith('s3://'):
+        return '/'.join(path[5:].split('/')[1:-2][-3:]) or 'unknown'
+    rel = os.path.relpath(os.path.dirname(path), root)
+    return 'local' if rel == '.' else rel
+
+
+def load_timings(path, n_threads=16, label=None):
+    """Load all the timing files under a local directory or s3 prefix
+
+    Args:
+        path (str): local directory or s3 prefix. e.g. s3://bucket/folder
+        n_threads (int, optional): threads used to read the files. Defaults to 16.
+        label (str, optional): group all the files under this label instead of
+            taking the group from the file path. Defaults to None.
+
+    Returns:
+        list: a dict for each scene with the scene, group, modified time and stage timings
+    """
+    # a single client is shared by the threads, creating clients is not thread safe
+    s3_client = boto3.client('s3') if path.startswith('s3://') else None
+    files = list_timing_files(path, s3_client=s3_client)
+    logger.info(f'Found {len(files)} timing files in {path}')
+    reader = partial(read_timing_file, s3_client=s3_client)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        timings = list(executor.map(reader, [f for f, _ in files]))
+    records = []
+    for (file_path, modified), timing in zip(files, timings):
+        records.append({
+            'scene': os.path.basename(file_path).replace(TIMING_SUFFIX, ''),
+            'group': label if label is not None else run_group(file_path, path),
+            'modified': modified,
+            'timing': timing,
+        })
+    return records
+
+
+def stage_summary(records):
+    """Summarise the stage timings of a set of scenes. The stages in a scene run
+    one after the other, so the share of the total time taken by each stage is
+    its share of the critical path.
+
+    Args:
+        records (list): records from load_timings
+
+    Returns:
+        list: a dict for each stage with n, p50, p95, max and mean seconds and
+            the share of the total time
+    """
+    stages = defaultdict(list)
+    for r in records:
+        for k, v in r['timing'].items():
+            if k != 'Total':
+                stages[k].append(v)
+    total = sum(sum(v) for v in stages.values())
+    summary = []
+    for stage, values in stages.items():
+        values = np.array(values, dtype=float)
+        summary.append({
+            'stage': stage,
+            'n': len(values),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'max': float(values.max()),
+            'mean': float(values.mean()),
+            'share': float(values.sum() / total) if total else 0.0,
+        })
+    return sorted(summary, key=lambda s: s['share'], reverse=True)
+
+
+def throughput(records, freq='day'):
+    """Number of scenes completed in each period, using the time the timing file
+    was last modified as the completion time
+
+    Args:
+        records (list): records from load_timings
+        freq (str, optional): 'hour' or 'day'. Defaults to 'day'.
+
+    Returns:
+        dict: period -> number of scenes completed
+    """
+    fmt = '%Y-%m-%d %H:00' if freq == 'hour' else '%Y-%m-%d'
+    counts = defaultdict(int)
+    for r in records:
+        counts[r['modified'].strftime(fmt)] += 1
+    return dict(sorted(counts.items()))
+
+
+def build_report(records, freq='day'):
+    """Summary of the stages and throughput for each group of runs"""
+    groups = defaultdict(list)
+    for r in records:
+        groups[r['group']].append(r)
+    report = {}
+    for group in sorted(groups):
+        group_records = groups[group]
+        totals = np.array([r['timing'].get('Total', sum(r['timing'].values()))
+                           for r in group_records], dtype=float)
+        report[group] = {
+            'n_scenes': len(group_records),
+            'total_p50': float(np.percentile(totals, 50)),
+            'total_p95': float(np.percentile(totals, 95)),
+            'stages': stage_summary(group_records),
+            'throughput': throughput(group_records, freq=freq),
+        }
+    return report
+
+
+def format_report(report):
+    """format the report as text"""
+    lines = []
+    for group, summary in report.items():
+        lines.append(f'{group}  scenes: {summary["n_scenes"]}  '
+                     f'total p50: {summary["total_p50"] / 60:.1f} min  '
+                     f'p95: {summary["total_p95"] / 60:.1f} min')
+        lines.append(f'  {"stage":<16}{"n":>6}{"p50 (s)":>10}{"p95 (s)":>10}'
+                     f'{"max (s)":>10}{"share":>8}')
+        for s in summary['stages']:
+            lines.append(f'  {s["stage"]:<16}{s["n"]:>6}{s["p50"]:>10.1f}{s["p95"]:>10.1f}'
+                         f'{s["max"]:>10.1f}{s["share"]:>8.1%}')
+        lines.append('  throughput (scenes): ' + ', '.join(
+            f'{k}: {v}' for k, v in summary['throughput'].items()))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def write_report_csv(report, csv_path):
+    """Write the report to a csv. The kind column separates the rows for the
+    total time of each group ('total'), each stage ('stage') and the scenes
+    completed in each period ('throughput')"""
+    fields = ['kind', 'group', 'stage', 'period', 'n', 'p50', 'p95', 'max', 'mean',
+              'share', 'scenes']
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for group, summary in report.items():
+            writer.writerow({'kind': 'total', 'group': group, 'stage': 'Total',
+                             'n': summary['n_scenes'], 'p50': summary['total_p50'],
+                             'p95': summary['total_p95']})
+            for s in summary['stages']:
+                writer.writerow({'kind': 'stage', 'group': group, **s})
+            for period, scenes in summary['throughput'].items():
+                writer.writerow({'kind': 'throughput', 'group': group,
+                                 'period': period, 'scenes': scenes})
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Summarise the stage timings of processed scenes')
+    parser.add_argument("--path", "-p", required=True, type=str,
+                        help="local directory or s3 prefix (s3://bucket/folder) containing timing files")
+    parser.add_argument("--csv", type=str, help="path to write the stage summary as a csv")
+    parser.add_argument("--label", type=str,
+                        help="group all timing files under this label instead of by software/config")
+    parser.add_argument("--freq", choices=['hour', 'day'], default='day',
+                        help="period used to report throughput")
+    parser.add_argument("--threads", type=int, default=16, help="threads used to read timing files")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    records = load_timings(args.path, n_threads=args.threads, label=args.label)
+    if len(records) == 0:
+        raise FileNotFoundError(f'No timing files found in {args.path}')
+    report = build_report(records, freq=args.freq)
+    print(format_report(report))
+    if args.csv:
+        write_report_csv(report, args.csv)
+        logger.info(f'Report written to : {args.csv}')